@@ -0,0 +1,115 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+# All refreshes run on one dedicated thread; a second caller for the same grant waits on the first one's future
+_refresh_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="token-refresh")
+_refresh_inflight = {}
+_refresh_lock = threading.Lock()
+
+
+@dataclass(slots=True, frozen=True)
+class StoredCreds:
+    """OAuth credentials as kept in the session."""
+    token: str
+    refresh_token: str | None
+    token_uri: str
+    client_id: str
+    client_secret: str
+    scopes: tuple[str, ...]
+    expiry: str | None = None
+
+    @classmethod
+    def from_session(cls, data):
+        return cls(**{**data, 'scopes': tuple(data.get('scopes') or ())})
+
+    @classmethod
+    def from_credentials(cls, creds, previous=None):
+        """Keeps the previous refresh_token if Google didn't send a new one."""
+        refresh_token = creds.refresh_token
+        if not refresh_token and previous:
+            refresh_token = previous.refresh_token
+        return cls(
+            token=creds.token,
+            refresh_token=refresh_token,
+            token_uri=creds.token_uri,
+            client_id=creds.client_id,
+            client_secret=creds.client_secret,
+            scopes=tuple(creds.scopes or ()),
+            expiry=creds.expiry.isoformat() if creds.expiry else None
+        )
+
+    def to_session(self):
+        return asdict(self)
+
+    def to_credentials(self):
+        return SharedRefreshCredentials(
+            token=self.token,
+            refresh_token=self.refresh_token,
+            token_uri=self.token_uri,
+            client_id=self.client_id,
+            client_secret=self.client_secret,
+            scopes=list(self.scopes),
+            expiry=datetime.fromisoformat(self.expiry) if self.expiry else None
+        )
+
+
+class SharedRefreshCredentials(Credentials):
+    """
+    Credentials whose refresh() goes through the shared refresh below. A job's pipeline threads all wrap one
+    instance, and google-auth doesn't lock its own refresh, so a token expiring mid-job would otherwise be
+    refreshed by every thread at once.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._token_lock = threading.Lock()
+
+    def refresh(self, request):
+        stale_token = self.token
+        with self._token_lock:
+            if self.token != stale_token:
+                # Another thread sharing this instance refreshed it while we waited
+                return
+            fresh = _shared_refresh(self)
+            if fresh is not self:
+                self.token = fresh.token
+                self.expiry = fresh.expiry
+                self._refresh_token = fresh.refresh_token
+                self._id_token = fresh.id_token
+
+
+def _refresh(key, creds):
+    try:
+        # The base class does the actual token request; SharedRefreshCredentials.refresh would land back here
+        Credentials.refresh(creds, Request())
+        return creds
+    finally:
+        with _refresh_lock:
+            _refresh_inflight.pop(key, None)
+
+
+def _shared_refresh(creds):
+    """Refreshes creds, or waits for the refresh already running for the same refresh_token and returns its result."""
+    key = creds.refresh_token
+    with _refresh_lock:
+        future = _refresh_inflight.get(key)
+        if future is None:
+            future = _refresh_executor.submit(_refresh, key, creds)
+            _refresh_inflight[key] = future
+    return future.result()
+
+
+def get_valid_credentials(stored):
+    """
+    Returns Credentials for a StoredCreds, refreshing them first if they have expired.
+    Concurrent calls for the same refresh_token share a single refresh request, and so do later refreshes
+    of the returned Credentials.
+    """
+    creds = stored.to_credentials()
+    if not creds.expired or not creds.refresh_token:
+        return creds
+    return _shared_refresh(creds)
@@ -1,50 +1,104 @@
-from fastapi import FastAPI, BackgroundTasks, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.middleware.sessions import SessionMiddleware
-from starlette.responses import RedirectResponse
-from pydantic import BaseModel
+from starlette.responses import RedirectResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, ConfigDict, Field, StringConstraints
+from typing import Annotated, Literal
+from contextlib import asynccontextmanager
+from enum import Enum
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
 import os
 import json
-try:
-    from api.processor import ImageProcessor
-except ImportError:
-    from processor import ImageProcessor
+import logging
+import re
+import time
+import httpx
+import orjson
+import requests
+from datetime import datetime, timedelta, timezone
+from api.processor import ImageProcessor, API_DIR
+from api.sessions import ServerSessionMiddleware, create_session_store
+from api.credentials import StoredCreds, get_valid_credentials
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
+from google.auth import jwt
 
-app = FastAPI(title="Image Processing API")
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger("api")
+
+# Finished jobs are kept around this long so the frontend can still read the result
+PROCESSOR_TTL_SECONDS = int(os.environ.get("PROCESSOR_TTL_SECONDS", "3600"))
+EVICTION_INTERVAL_SECONDS = 60
+# Comment line sent on idle SSE streams so proxies don't drop the connection
+SSE_KEEPALIVE_SECONDS = 15
+
+# Image jobs run on their own bounded pool instead of the threadpool that serves requests;
+# jobs beyond the limit wait in the pool's queue
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "2"))
+job_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS, thread_name_prefix="image-job")
+
+# Google API connections kept open per worker; jobs run on threads, so this matches MAX_CONCURRENT_JOBS with headroom
+GOOGLE_POOL_SIZE = int(os.environ.get("GOOGLE_POOL_SIZE", "20"))
+
+# One processor per authenticated user, keyed by client_id + email
+processors = {}
+processors_lock = asyncio.Lock()
+
+async def evict_finished_processors():
+    while True:
+        await asyncio.sleep(EVICTION_INTERVAL_SECONDS)
+        cutoff = time.time() - PROCESSOR_TTL_SECONDS
+        async with processors_lock:
+            expired = [key for key, p in processors.items() if p.finished_at and p.finished_at < cutoff]
+            for key in expired:
+                del processors[key]
+
+def log_job_failure(task):
+    # run_process handles its own errors, so anything here is a bug in the job plumbing
+    if not task.cancelled() and task.exception():
+        logger.error("Image job task failed", exc_info=task.exception())
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared client for the OAuth token exchange, so auth callbacks don't tie up threadpool workers
+    app.state.http = httpx.AsyncClient(http2=True, timeout=10)
+    # Keep-alive pool handed to every ImageProcessor, so jobs reuse TLS connections to the Google APIs
+    app.state.google_adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=GOOGLE_POOL_SIZE)
+    eviction_task = asyncio.create_task(evict_finished_processors())
+    yield
+    eviction_task.cancel()
+    await app.state.http.aclose()
+    app.state.google_adapter.close()
+    job_executor.shutdown(wait=False, cancel_futures=True)
+
+app = FastAPI(title="Image Processing API", lifespan=lifespan)
 
 # Allow CORS for frontend
-fe_url = os.environ.get("FRONTEND_URL", "").strip()
-origins = [
-    "http://localhost:3000",
-    "http://127.0.0.1:3000",
-]
+# Starlette compiles this once and fullmatches each Origin against it.
+# FRONTEND_URL is allowed exactly; set CORS_REGEX to widen it (e.g. to this project's Vercel preview URLs).
+# A blanket *.vercel.app is deliberately not the default since credentials are allowed.
+fe_url = os.environ.get("FRONTEND_URL", "").strip().rstrip("/")
+cors_origins = [r"http://localhost:3000", r"http://127\.0\.0\.1:3000"]
 if fe_url:
-    origins.append(fe_url)
-    # Also add version without trailing slash if it has one, or vice versa
-    if fe_url.endswith("/"):
-        origins.append(fe_url[:-1])
-    else:
-        origins.append(fe_url + "/")
-
-# Remove empty/duplicate strings
-origins = list(set([o for o in origins if o]))
+    cors_origins.append(re.escape(fe_url))
+cors_regex = os.environ.get("CORS_REGEX", "|".join(cors_origins))
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=origins,
+    allow_origin_regex=cors_regex,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
 # Session Middleware for auth
+# Session data lives in Redis (REDIS_URL) or process memory; the cookie only holds the session id
 # same_site="none" and https_only=True are required for cross-domain cookies (Vercel -> Render)
 app.add_middleware(
-    SessionMiddleware, 
-    secret_key=os.environ.get("SECRET_KEY", "dev_secret_key_12345"),
+    ServerSessionMiddleware,
+    store=create_session_store(os.environ.get("REDIS_URL")),
     same_site="none",
     https_only=True
 )
@@ -66,187 +120,292 @@ async def add_partitioned_cookie(request: Request, call_next):
             response.headers.append("set-cookie", header)
     return response
 
-SCOPES = [
+SCOPES = (
     'https://www.googleapis.com/auth/drive',
     'https://www.googleapis.com/auth/spreadsheets',
     'openid', 'https://www.googleapis.com/auth/userinfo.email', 'https://www.googleapis.com/auth/userinfo.profile'
-]
+)
+
+class CredSource(Enum):
+    ENV = "env"
+    FILE = "file"
+    NONE = "none"
+
+def detect_creds():
+    """
+    Resolves the OAuth client config once at startup, so the auth handlers never touch the disk.
+    Returns (source, config, error).
+    """
+    # Priority 1: env var (for production)
+    env_creds = os.environ.get("GOOGLE_CLIENT_SECRET_JSON")
+    if env_creds:
+        try:
+            return CredSource.ENV, json.loads(env_creds), None
+        except json.JSONDecodeError:
+            return CredSource.NONE, None, "Invalid GOOGLE_CLIENT_SECRET_JSON format"
+
+    # Priority 2: local file (for dev)
+    credentials_file = os.path.join(API_DIR, 'credentials.json')
+    try:
+        with open(credentials_file) as f:
+            return CredSource.FILE, json.load(f), None
+    except FileNotFoundError:
+        pass
+
+    return CredSource.NONE, None, "credentials.json not found and GOOGLE_CLIENT_SECRET_JSON not set"
+
+CRED_SOURCE, CLIENT_CONFIG, CLIENT_CONFIG_ERROR = detect_creds()
+logger.info("OAuth client config source: %s", CRED_SOURCE.value)
+
+# Env config doesn't change at runtime; tests can reset these with .cache_clear()
+@lru_cache(maxsize=1)
+def redirect_uri():
+    return os.environ.get("GOOGLE_REDIRECT_URI", "http://localhost:8000/api/auth/callback")
+
+@lru_cache(maxsize=1)
+def frontend_url():
+    return os.environ.get("FRONTEND_URL", "http://localhost:3000")
+
+def make_flow():
+    return Flow.from_client_config(
+        CLIENT_CONFIG,
+        scopes=SCOPES,
+        redirect_uri=redirect_uri()
+    )
+
+async def exchange_code(http, code, code_verifier=None):
+    """Exchanges the authorization code for credentials over the shared async HTTP client."""
+    client = CLIENT_CONFIG.get("web") or CLIENT_CONFIG.get("installed")
+    data = {
+        "grant_type": "authorization_code",
+        "code": code,
+        "client_id": client["client_id"],
+        "client_secret": client["client_secret"],
+        "redirect_uri": redirect_uri(),
+    }
+    if code_verifier:
+        data["code_verifier"] = code_verifier
+
+    response = await http.post(client["token_uri"], data=data)
+    response.raise_for_status()
+    token = response.json()
+    # google-auth compares expiry against naive UTC
+    expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=token.get("expires_in", 3600))
+    return Credentials(
+        token=token["access_token"],
+        refresh_token=token.get("refresh_token"),
+        id_token=token.get("id_token"),
+        expiry=expiry,
+        token_uri=client["token_uri"],
+        client_id=client["client_id"],
+        client_secret=client["client_secret"],
+        scopes=token["scope"].split() if token.get("scope") else SCOPES
+    )
+
+# Google Drive / Sheets IDs; checked here so a typo is rejected with a 422 before any job or API call
+DriveId = Annotated[str, StringConstraints(pattern=r"^[A-Za-z0-9_-]{10,100}$")]
+OptionalDriveId = Annotated[str, StringConstraints(pattern=r"^([A-Za-z0-9_-]{10,100})?$")]
+Dimension = Annotated[int, Field(ge=16, le=16384)]
 
 class Config(BaseModel):
-    project_name: str
-    input_folder_id: str
-    output_root_folder_id: str
-    spreadsheet_id: str = ""
-    width: int
-    height: int
-    quality: int = 95
-    logo_safe_area: float = 0.8
+    model_config = ConfigDict(extra="forbid", frozen=True, str_strip_whitespace=True)
+
+    project_name: Annotated[str, StringConstraints(min_length=1, max_length=200)]
+    input_folder_id: DriveId
+    output_root_folder_id: DriveId
+    spreadsheet_id: OptionalDriveId = ""
+    width: Dimension
+    height: Dimension
+    quality: Annotated[int, Field(ge=1, le=100)] = 90
+    logo_safe_area: Annotated[float, Field(gt=0, le=1)] = 0.8
     force_contain_mode: bool = False
-    processing_mode: str = "photos"
+    processing_mode: Literal["photos", "logos"] = "photos"
+
+# Constant payloads are serialized once at import. A fresh Response wraps them per request because
+# middlewares (CORS, session cookie) append headers to the response in place.
+ROOT_BODY = orjson.dumps({"status": "ok", "message": "Image Processing API is running"})
+AUTHENTICATED_BODY = orjson.dumps({"authenticated": True})
+NOT_AUTHENTICATED_BODY = orjson.dumps({"authenticated": False})
+STOPPING_BODY = orjson.dumps({"status": "stopping"})
+IDLE_STATUS_BODY = orjson.dumps({"status": "idle", "status_message": "待機中", "logs": [], "result_links": None, "progress": None})
+
+def json_response(body, headers=None):
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def get_processor_key(request: Request):
+    creds_data = request.session.get('credentials')
+    user_email = request.session.get('user_email')
+    if not creds_data or not user_email:
+        return None
+    return f"{creds_data['client_id']}:{user_email}"
 
-# Global instance to hold state
-processor_instance = None
+SESSION_EXPIRED_DETAIL = "ログインセッションが有効ではありません。一度ログアウト（ブラウザ更新）してログインし直してください。"
+
+def get_optional_creds(request: Request) -> StoredCreds | None:
+    # FastAPI caches dependencies per request, so the session entry is only decoded once
+    creds_data = request.session.get('credentials')
+    return StoredCreds.from_session(creds_data) if creds_data else None
+
+def get_current_creds(creds: StoredCreds | None = Depends(get_optional_creds)) -> StoredCreds:
+    if creds is None:
+        raise HTTPException(status_code=401, detail=SESSION_EXPIRED_DETAIL)
+    return creds
 
 @app.get("/")
 def read_root(request: Request):
-    origin = request.headers.get("origin")
-    redirect_uri = os.environ.get("GOOGLE_REDIRECT_URI")
-    print(f"DEBUG: Incoming request from origin: {origin}")
-    print(f"DEBUG: Current GOOGLE_REDIRECT_URI: {redirect_uri}")
-    return {
-        "status": "ok", 
-        "message": "Image Processing API is running",
-        "debug_origin": origin,
-        "allowed_origins": origins,
-        "debug_redirect_uri": redirect_uri
-    }
+    logger.debug("Incoming request from origin: %s", request.headers.get("origin"))
+    return json_response(ROOT_BODY)
 
 @app.get("/api/auth/login")
-def login(request: Request):
-    client_config = None
-    redirect_uri = os.environ.get("GOOGLE_REDIRECT_URI", "http://localhost:8000/api/auth/callback")
-    print(f"DEBUG: Using redirect_uri for flow: {redirect_uri}")
-    
-    # Priority 1: env var (for production)
-    env_creds = os.environ.get("GOOGLE_CLIENT_SECRET_JSON")
-    if env_creds:
-        try:
-            client_config = json.loads(env_creds)
-        except json.JSONDecodeError:
-            return {"error": "Invalid GOOGLE_CLIENT_SECRET_JSON format"}
-            
-    # Priority 2: local file (for dev)
-    elif os.path.exists('credentials.json'):
-         pass
-    
-    if env_creds and client_config:
-        flow = Flow.from_client_config(
-            client_config,
-            scopes=SCOPES,
-            redirect_uri=redirect_uri
-        )
-    elif os.path.exists('credentials.json'):
-         flow = Flow.from_client_secrets_file(
-            'credentials.json',
-            scopes=SCOPES,
-            redirect_uri=redirect_uri
-        )
-    else:
+async def login(request: Request):
+    logger.debug("Using redirect_uri for flow: %s", redirect_uri())
+    if CRED_SOURCE is CredSource.NONE:
         return {
-            "error": "credentials.json not found and GOOGLE_CLIENT_SECRET_JSON not set",
-            "debug_redirect_uri_used": redirect_uri
+            "error": CLIENT_CONFIG_ERROR,
+            "debug_redirect_uri_used": redirect_uri()
         }
-        
+
+    flow = make_flow()
     authorization_url, state = flow.authorization_url(
         access_type='offline', 
         include_granted_scopes='true',
         prompt='consent'
     )
     request.session['state'] = state
-    return {"url": authorization_url, "debug_redirect_uri_used": redirect_uri}
+    # Flow generates a PKCE verifier; the callback has to send it back with the code
+    request.session['code_verifier'] = flow.code_verifier
+    return {"url": authorization_url, "debug_redirect_uri_used": redirect_uri()}
 
 @app.get("/api/auth/callback")
-def auth_callback(request: Request, code: str, state: str):
-    env_creds = os.environ.get("GOOGLE_CLIENT_SECRET_JSON")
-    flow = None
-    
-    if env_creds:
-        try:
-            client_config = json.loads(env_creds)
-            flow = Flow.from_client_config(
-                client_config,
-                scopes=SCOPES,
-                state=state,
-                redirect_uri=os.environ.get("GOOGLE_REDIRECT_URI", "http://localhost:8000/api/auth/callback")
-            )
-        except:
-             return {"error": "Invalid GOOGLE_CLIENT_SECRET_JSON"}
-    elif os.path.exists('credentials.json'):
-        flow = Flow.from_client_secrets_file(
-            'credentials.json',
-            scopes=SCOPES,
-            state=state,
-            redirect_uri=os.environ.get("GOOGLE_REDIRECT_URI", "http://localhost:8000/api/auth/callback")
-        )
-    else:
-        return {"error": "Server missing credentials configuration"}
-    flow.fetch_token(code=code)
-    creds = flow.credentials
+async def auth_callback(request: Request, code: str, state: str):
+    if CRED_SOURCE is CredSource.NONE:
+        return {"error": CLIENT_CONFIG_ERROR}
+
+    try:
+        creds = await exchange_code(request.app.state.http, code, request.session.pop('code_verifier', None))
+    except httpx.HTTPError as e:
+        return {"error": f"Token exchange failed: {e}"}
     
     # Store credentials in session (serialized)
-    request.session['credentials'] = {
-        'token': creds.token,
-        'refresh_token': creds.refresh_token,
-        'token_uri': creds.token_uri,
-        'client_id': creds.client_id,
-        'client_secret': creds.client_secret,
-        'scopes': creds.scopes
-    }
+    request.session['credentials'] = StoredCreds.from_credentials(creds).to_session()
+    # The id_token comes straight from Google's token endpoint over TLS, so no signature check is needed here
+    if creds.id_token:
+        request.session['user_email'] = jwt.decode(creds.id_token, verify=False).get('email')
     
     # Redirect back to frontend
-    frontend_url = os.environ.get("FRONTEND_URL", "http://localhost:3000")
-    return RedirectResponse(url=f"{frontend_url}?authenticated=true")
+    return RedirectResponse(url=f"{frontend_url()}?authenticated=true")
 
 @app.get("/api/auth/check")
-def check_auth(request: Request):
-    creds_data = request.session.get('credentials')
-    if creds_data:
-        return {"authenticated": True}
-    return {"authenticated": False}
+def check_auth(creds: StoredCreds | None = Depends(get_optional_creds)):
+    if creds:
+        return json_response(AUTHENTICATED_BODY)
+    return json_response(NOT_AUTHENTICATED_BODY)
 
 @app.post("/api/start")
-async def start_process(config: Config, background_tasks: BackgroundTasks, request: Request):
-    global processor_instance
-    
-    # Log session for debugging (safely)
-    session_keys = list(request.session.keys())
-    print(f"DEBUG: Session keys at /api/start: {session_keys}")
-    
-    creds_data = request.session.get('credentials')
-    if not creds_data:
-        print("ERROR: No credentials found in session at /api/start")
-        return {
-            "status": "error", 
-            "message": "ログインセッションが有効ではありません。一度ログアウト（ブラウザ更新）してログインし直してください。"
-        }
+async def start_process(config: Config, request: Request, stored: StoredCreds = Depends(get_current_creds)):
+    key = get_processor_key(request)
+    if not key:
+        logger.error("No user in session at /api/start")
+        raise HTTPException(status_code=401, detail=SESSION_EXPIRED_DETAIL)
 
-    if processor_instance and processor_instance.status == "running":
-        return {"status": "error", "message": "Already running"}
+    # Refresh an expired token once here (shared with any concurrent refresh) and keep the result in the session
+    try:
+        creds = await run_in_threadpool(get_valid_credentials, stored)
+    except Exception as e:
+        logger.error("Token refresh failed at /api/start: %s", e)
+        raise HTTPException(status_code=401, detail="トークンの更新に失敗しました。再度ログインしてください。")
+    if creds.token != stored.token:
+        stored = StoredCreds.from_credentials(creds, stored)
+        request.session['credentials'] = stored.to_session()
+
+    async with processors_lock:
+        processor_instance = processors.get(key)
+        if processor_instance and processor_instance.status == "running":
+            raise HTTPException(status_code=409, detail="Already running")
 
-    # Initialize new processor with config AND credentials
-    processor_instance = ImageProcessor(config.dict(), creds_data)
+        # Initialize new processor with config AND credentials
+        processor_instance = ImageProcessor(config, stored, http_adapter=request.app.state.google_adapter)
+        # Mark as running before releasing the lock so a concurrent start is rejected
+        processor_instance.status = "running"
+        processor_instance.publish()
+        processors[key] = processor_instance
     
-    # Run in background
-    background_tasks.add_task(processor_instance.run_process)
+    # Run in background; the task is kept on the processor so /api/stop can cancel it
+    processor_instance.task = asyncio.create_task(processor_instance.run_process_async(job_executor))
+    processor_instance.task.add_done_callback(log_job_failure)
     
     return {"status": "started"}
 
 @app.post("/api/stop")
-def stop_process():
-    global processor_instance
+async def stop_process(request: Request):
+    processor_instance = processors.get(get_processor_key(request))
     if processor_instance and processor_instance.status == "running":
-        processor_instance.stop_requested = True
-        return {"status": "stopping"}
-    return {"status": "failed", "message": "No running process"}
+        # A repeated stop while the current file finishes just reports the stop already under way
+        if not processor_instance.stop_requested:
+            processor_instance.task.cancel()
+        return json_response(STOPPING_BODY)
+    raise HTTPException(status_code=400, detail="No running process")
 
 @app.get("/api/status")
-def get_status():
-    global processor_instance
+async def get_status(request: Request):
+    processor_instance = processors.get(get_processor_key(request))
     if processor_instance:
+        snapshot = processor_instance.atomic_snapshot()
         # Debug logging for progress issues
-        print(f"DEBUG /api/status: status={processor_instance.status}, processed={processor_instance.processed_count}, total={processor_instance.total_files}")
-        return {
-            "status": processor_instance.status,
-            "status_message": processor_instance.status_message,
-            "logs": processor_instance.logs,
-            "result_links": processor_instance.result_links,
-            "progress": {
-                "processed": processor_instance.processed_count,
-                "total": processor_instance.total_files
-            }
-        }
-    return {"status": "idle", "status_message": "待機中", "logs": [], "result_links": None, "progress": None}
+        logger.debug("/api/status: status=%s, progress=%s", snapshot['status'], snapshot['progress'])
+        # no-cache makes the browser revalidate with If-None-Match, so unchanged polls come back as 304
+        etag = f'"{processor_instance.job_id}-{snapshot["version"]}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return json_response(orjson.dumps(snapshot), headers=headers)
+    return json_response(IDLE_STATUS_BODY)
+
+@app.get("/api/status/stream")
+async def stream_status(request: Request):
+    """
+    Server-Sent Events version of /api/status. Sends the full snapshot once, then one event per
+    progress tick carrying only the new log line. /api/status stays as the polling fallback.
+    """
+    processor_instance = processors.get(get_processor_key(request))
+    if not processor_instance:
+        raise HTTPException(status_code=404, detail="No process")
+
+    queue = asyncio.Queue()
+
+    async def events():
+        # Subscribing inside the generator pairs it with the finally below, even if the client is gone
+        # before Starlette starts iterating
+        try:
+            processor_instance.subscribe(asyncio.get_running_loop(), queue)
+            # Taken after subscribing so no tick is missed; events already included in it are skipped below
+            snapshot = processor_instance.atomic_snapshot()
+            yield f"event: snapshot\ndata: {orjson.dumps(snapshot).decode()}\n\n"
+            status = snapshot["status"]
+            while status == "running":
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event["version"] <= snapshot["version"]:
+                    continue
+                status = event["status"]
+                yield f"data: {orjson.dumps(event).decode()}\n\n"
+        finally:
+            processor_instance.unsubscribe(queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Running jobs live in this process's memory, so extra workers (WEB_CONCURRENCY) only make sense
+    # with REDIS_URL set and sticky sessions in front; a user's status/stop must reach the worker running their job
+    uvicorn.run(
+        "api.main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.environ.get("WEB_CONCURRENCY", "1")),
+        loop="uvloop",
+        http="httptools"
+    )
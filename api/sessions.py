@@ -0,0 +1,125 @@
+import orjson
+import secrets
+import time
+from collections import OrderedDict
+from starlette.datastructures import MutableHeaders
+from starlette.requests import HTTPConnection
+
+# Same lifetime the signed session cookie used to have
+SESSION_MAX_AGE = 14 * 24 * 60 * 60
+
+# How long a worker trusts its local copy of a Redis session before re-reading it
+LOCAL_CACHE_SECONDS = 30
+LOCAL_CACHE_SIZE = 1024
+
+
+class MemorySessionStore:
+    """Keeps sessions in process memory. Used when no REDIS_URL is configured."""
+
+    def __init__(self):
+        self._data = {}
+
+    async def get(self, session_id):
+        entry = self._data.get(session_id)
+        if not entry or entry[1] < time.time():
+            return None
+        return orjson.loads(entry[0])
+
+    async def set(self, session_id, data, ttl):
+        now = time.time()
+        # Drop expired sessions as we go so abandoned logins don't accumulate
+        for key in [k for k, (_, expires) in self._data.items() if expires < now]:
+            del self._data[key]
+        self._data[session_id] = (orjson.dumps(data), now + ttl)
+
+    async def delete(self, session_id):
+        self._data.pop(session_id, None)
+
+
+class RedisSessionStore:
+    """Keeps sessions in Redis with a small per-worker cache in front of it."""
+
+    def __init__(self, url):
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self._cache = OrderedDict()
+
+    def _remember(self, session_id, data):
+        self._cache[session_id] = (data, time.monotonic() + LOCAL_CACHE_SECONDS)
+        self._cache.move_to_end(session_id)
+        while len(self._cache) > LOCAL_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    async def get(self, session_id):
+        cached = self._cache.get(session_id)
+        if cached and cached[1] > time.monotonic():
+            # Callers may mutate the session, so hand out a copy
+            return orjson.loads(cached[0])
+
+        raw = await self._redis.get(f"session:{session_id}")
+        if raw is None:
+            return None
+        self._remember(session_id, raw)
+        return orjson.loads(raw)
+
+    async def set(self, session_id, data, ttl):
+        raw = orjson.dumps(data)
+        await self._redis.setex(f"session:{session_id}", ttl, raw)
+        self._remember(session_id, raw)
+
+    async def delete(self, session_id):
+        self._cache.pop(session_id, None)
+        await self._redis.delete(f"session:{session_id}")
+
+
+def create_session_store(redis_url=None):
+    if redis_url:
+        return RedisSessionStore(redis_url)
+    return MemorySessionStore()
+
+
+class ServerSessionMiddleware:
+    """
+    Drop-in replacement for Starlette's SessionMiddleware that keeps the session data server-side.
+    The cookie only carries a random 128-bit session id, so credentials never travel with each request.
+    """
+
+    def __init__(self, app, store, session_cookie="session", max_age=SESSION_MAX_AGE, same_site="lax", https_only=False):
+        self.app = app
+        self.store = store
+        self.session_cookie = session_cookie
+        self.max_age = max_age
+        self.security_flags = "httponly; samesite=" + same_site
+        if https_only:
+            self.security_flags += "; secure"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        connection = HTTPConnection(scope)
+        session_id = connection.cookies.get(self.session_cookie)
+        data = await self.store.get(session_id) if session_id else None
+        if data is None:
+            session_id = None
+        scope["session"] = data or {}
+        initial = orjson.dumps(scope["session"], option=orjson.OPT_SORT_KEYS)
+
+        async def send_wrapper(message):
+            nonlocal session_id
+            if message["type"] == "http.response.start":
+                session = scope["session"]
+                if session and orjson.dumps(session, option=orjson.OPT_SORT_KEYS) != initial:
+                    if session_id is None:
+                        session_id = secrets.token_urlsafe(16)
+                    await self.store.set(session_id, session, self.max_age)
+                    headers = MutableHeaders(scope=message)
+                    headers.append("Set-Cookie", f"{self.session_cookie}={session_id}; path=/; Max-Age={self.max_age}; {self.security_flags}")
+                elif not session and session_id is not None:
+                    await self.store.delete(session_id)
+                    headers = MutableHeaders(scope=message)
+                    headers.append("Set-Cookie", f"{self.session_cookie}=null; path=/; expires=Thu, 01 Jan 1970 00:00:00 GMT; {self.security_flags}")
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
@@ -94,7 +94,11 @@ export default function Home() {
         if (parsed.photo_width && !parsed.width) parsed.width = parsed.photo_width;
         if (parsed.photo_height && !parsed.height) parsed.height = parsed.photo_height;
 
-        setConfig(prev => ({ ...prev, ...parsed }));
+        // The API rejects unknown fields, so only carry over keys the current form knows about
+        setConfig(prev => {
+          const known = Object.fromEntries(Object.entries(parsed).filter(([k]) => k in prev));
+          return { ...prev, ...known };
+        });
       } catch (e) {
         console.error("Failed to load config", e);
       }
@@ -106,11 +110,65 @@ export default function Home() {
     localStorage.setItem('image_proc_config', JSON.stringify(config));
   }, [config]);
 
+  // Live updates come over SSE; polling /api/status is only the fallback if the stream fails
+  const [useStream, setUseStream] = useState(true);
+  const [jobStarted, setJobStarted] = useState(false);
+
+  const applyStatus = (data: any) => {
+    if (data.progress) {
+      setProgress(data.progress);
+    }
+    // Result links checked separately to ensure they are captured
+    if (data.result_links) {
+      setResultLinks(data.result_links);
+    }
+    if (data.status === 'completed' || data.status === 'error' || data.status === 'stopped') {
+      setStatus(data.status);
+    }
+  };
+
+  useEffect(() => {
+    if (status !== 'running' || !jobStarted || !useStream) return;
+
+    const source = new EventSource(`${baseUrl}/api/status/stream`, { withCredentials: true });
+
+    // Full state once on connect
+    source.addEventListener('snapshot', (e) => {
+      const data = JSON.parse((e as MessageEvent).data);
+      setLogs(data.logs);
+      if (data.logs.length > 0) {
+        setLastLog(data.logs[data.logs.length - 1]);
+      }
+      applyStatus(data);
+    });
+
+    // Then one event per progress tick with only the new log line
+    source.onmessage = (e) => {
+      const data = JSON.parse(e.data);
+      if (data.log) {
+        setLogs(prev => [...prev, data.log].slice(-500));
+        setLastLog(data.log);
+      }
+      if (data.status !== 'running') {
+        source.close();
+      }
+      applyStatus(data);
+    };
+
+    source.onerror = () => {
+      console.error("Status stream failed, falling back to polling");
+      source.close();
+      setUseStream(false);
+    };
+
+    return () => source.close();
+  }, [status, jobStarted, useStream]);
+
   useEffect(() => {
     let interval: NodeJS.Timeout;
 
-    // Always poll if running, or if we just completed but missed links (safety net), or if stopping
-    if (status === 'running' || (status === 'completed' && !resultLinks) || status === 'stopping') {
+    // Poll if streaming is unavailable, or if we just completed but missed links (safety net), or if stopping
+    if ((status === 'running' && !useStream) || (status === 'completed' && !resultLinks) || status === 'stopping') {
       interval = setInterval(async () => {
         try {
           const res = await axios.get(`${baseUrl}/api/status`, { withCredentials: true });
@@ -122,27 +180,9 @@ export default function Home() {
             }
           }
 
-          if (res.data.progress) {
-            setProgress(res.data.progress);
-          }
-
-          // Result links checked separately to ensure they are captured
-          if (res.data.result_links) {
-            setResultLinks(res.data.result_links);
-          }
-
-          if (res.data.status === 'completed') {
-            setStatus('completed');
-            if (res.data.result_links) clearInterval(interval);
-          }
-
-          if (res.data.status === 'error') {
-            setStatus('error');
-            clearInterval(interval);
-          }
+          applyStatus(res.data);
 
-          if (res.data.status === 'stopped') {
-            setStatus('stopped');
+          if ((res.data.status === 'completed' && res.data.result_links) || res.data.status === 'error' || res.data.status === 'stopped') {
             clearInterval(interval);
           }
           console.log("Status update received:", res.data);
@@ -152,19 +192,24 @@ export default function Home() {
       }, 1000);
     }
     return () => clearInterval(interval);
-  }, [status, resultLinks]);
+  }, [status, resultLinks, useStream]);
 
   const startProcess = async () => {
     try {
       setStatus('running');
+      setJobStarted(false);
+      // A stream failure during an earlier job shouldn't pin this one to polling
+      setUseStream(true);
       setLogs([]);
       setResultLinks(null);
       setProgress(null);
       await axios.post(`${baseUrl}/api/start`, config, { withCredentials: true });
+      // Only attach the stream once the server has a process for us
+      setJobStarted(true);
     } catch (e) {
       console.error(e);
       setStatus('error');
-      setLogs(prev => [...prev, "処理の開始に失敗しました: " + String(e)]);
+      setLogs(prev => [...prev, "処理の開始に失敗しました: " + errorDetail(e)]);
     }
   };
 
@@ -174,6 +219,7 @@ export default function Home() {
       setLogs(prev => [...prev, "中断リクエストを送信しました..."]);
     } catch (e) {
       console.error("Stop error", e);
+      setLogs(prev => [...prev, "中断リクエストに失敗しました: " + errorDetail(e)]);
     }
   };
 
@@ -386,6 +432,15 @@ export default function Home() {
   );
 }
 
+// Prefer the API's error detail (401 session expired, 409 already running, 422 validation, ...) over the generic axios message
+function errorDetail(e: unknown): string {
+  if (axios.isAxiosError(e) && e.response?.data?.detail) {
+    const detail = e.response.data.detail;
+    return typeof detail === 'string' ? detail : JSON.stringify(detail);
+  }
+  return String(e);
+}
+
 function InputGroup({ label, value, onChange, type = "text", placeholder }: { label: string, value: string | number, onChange: (v: any) => void, type?: string, placeholder?: string }) {
   return (
     <div>
@@ -15,11 +15,12 @@ else
     echo "Python venv not found. Please run setup first."
     exit 1
 fi
+cd ..
 
-nohup uvicorn main:app --reload --port 8000 > ../backend.log 2>&1 &
+# Run from the repo root so the api package imports resolve
+nohup uvicorn api.main:app --reload --port 8000 --loop uvloop --http httptools > backend.log 2>&1 &
 BACKEND_PID=$!
 echo "Backend started (PID: $BACKEND_PID)."
-cd ..
 
 # Start Frontend
 echo "Starting Frontend..."